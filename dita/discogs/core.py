@@ -35,6 +35,10 @@ HEADERS = {"Cache-Control": "no-cache"}
 if DISCOGS_TOKEN:
     HEADERS["Authorization"] = f"Discogs token={DISCOGS_TOKEN}"
 
+# shared across all api calls, so that the connection (and tls handshake) to
+# api.discogs.com is kept alive between requests
+SESSION = requests.Session()
+
 API_PREFIX = "https://api.discogs.com"
 PREFIX = "https://www.discogs.com"
 
@@ -103,7 +107,7 @@ def d_get(
     # requests.exceptions.ChunkedEncodingError
     # requests.exceptions.MissingSchema (int.0)
     try:
-        response = requests.get(
+        response = SESSION.get(
             query,
             headers=HEADERS,
             timeout=timeout,
@@ -112,7 +116,7 @@ def d_get(
         # allow 1 timeout; this is usually ok
         print("timed out; retrying...")
         time.sleep(5)
-        response = requests.get(
+        response = SESSION.get(
             query,
             headers=HEADERS,
             timeout=timeout,
@@ -10,7 +10,6 @@ import sys
 import time
 
 import pandas as pd
-import requests
 
 import dita.discogs.core as dc
 from dita.config import TARGET_DIR
@@ -212,7 +211,7 @@ def rate_release(
     # https://www.discogs.com/developers#page:database,header:database-release-rating-by-user-put
     url = dc.API_PREFIX + f"/releases/{release_id}/rating/{dc.USERNAME}"
     current_rating: str = json.loads(
-        requests.get(
+        dc.SESSION.get(
             url=url,
             headers=dc.HEADERS,
             timeout=3,
@@ -245,7 +244,7 @@ def rate_release(
     )
     dc.HEADERS["Content-Type"] = "application/json"
     # put is idempotent
-    response = requests.put(
+    response = dc.SESSION.put(
         url=url,
         data=data,
         headers=dc.HEADERS,
@@ -262,7 +261,7 @@ def rate_release(
     # (post is not idempotent)
     # https://www.discogs.com/developers#page:user-collection,header:user-collection-add-to-collection-folder
     response = json.loads(
-        requests.post(
+        dc.SESSION.post(
             url=dc.API_PREFIX
             + f"/users/{dc.USERNAME}/collection/folders/1/releases/{release_id}",
             headers=dc.HEADERS,
@@ -9,6 +9,7 @@ variable name rel instead of release.
 import os
 import shlex
 import sys
+from collections import Counter
 from urllib.parse import quote_plus
 
 import numpy as np
@@ -388,17 +389,19 @@ def get_release_tracklist(release: dict) -> pd.DataFrame:
     # https://www.discogs.com/release/1945094
 
     titles = df.title.apply(lambda x: x.strip()).to_list()
-    n_titles = len(titles)
+    half = len(titles) // 2
     if (
-        # n_titles > 2
-        # and
-        n_titles % 2 == 0
-        and titles[: n_titles // 2] == titles[n_titles // 2 :]
-        # and all(titles.count(x) % 2 == 0 for x in titles)
-        and all(titles.count(x) == 2 for x in titles)
+        # cheapest checks first
+        titles
+        and len(titles) % 2 == 0
+        and titles[0] == titles[half]
+        and titles[-1] == titles[half - 1]
+        and titles[:half] == titles[half:]
+        # and all(n % 2 == 0 for n in Counter(titles).values())
+        and all(n == 2 for n in Counter(titles).values())
     ):
         lprint("Doubled tracklist detected")
-        df = df[: n_titles // 2]
+        df = df.iloc[:half]
 
     # print(df)
     return df
@@ -2,43 +2,56 @@
 """Module for converting audio files to MP3."""
 
 import argparse
-import multiprocessing
 import os
 import re
-import shlex
-import shutil
 import sys
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from subprocess import PIPE, Popen
-from typing import Any
 
-from mutagen._file import File
 from mutagen.aiff import AIFF
 from mutagen.easymp4 import EasyMP4
 from mutagen.flac import FLAC
-from mutagen.mp3 import MP3, EasyMP3
+from mutagen.id3 import ID3, ID3NoHeaderError
+from mutagen.mp3 import MP3
 from mutagen.mp4 import MP4StreamInfoError
 from mutagen.oggopus import OggOpus
 from tinytag import TinyTag
 from tinytag.tinytag import TinyTagException
+from tqdm import tqdm
 
 from dita.config import CONFIG, SOURCE_DIR
 from dita.tag.core import fill_tracknum
 from dita.tag.io import glob_full, is_audio_file
 
 BITRATE_TARGET = int(CONFIG["convert"]["bitrate"])
-CONVERT_EXTENSIONS = [x.lower() for x in CONFIG["convert"]["filetypes"].split(",")]
-
+CONVERT_EXTENSIONS = frozenset(
+    x.lower() for x in CONFIG["convert"]["filetypes"].split(",")
+)
+if "m4a" in CONVERT_EXTENSIONS:
+    # m4a ext = mp4 filetype (see is_audio_file)
+    CONVERT_EXTENSIONS |= {"mp4"}
+
+# ffmpeg's libmp3lame equivalents are required for non-flac lossless files
 if BITRATE_TARGET in {256, 320}:
     BITRATE_ARG = f"-b {BITRATE_TARGET}"
+    FFMPEG_BITRATE_ARG = f"-b:a {BITRATE_TARGET}k"
 elif BITRATE_TARGET in {0, 1, 2, 3, 4}:
     BITRATE_ARG = f"-V {BITRATE_TARGET}"
+    FFMPEG_BITRATE_ARG = f"-q:a {BITRATE_TARGET}"
 else:
     print("Bitrate was not set in config; defaulting to V0")
     BITRATE_ARG = "-V 0"
+    FFMPEG_BITRATE_ARG = "-q:a 0"
+
+# encoder args are identical for every file, so build them once instead of
+# once per file
+LAME_ARGS = ["lame", "--silent", *BITRATE_ARG.split()]
+FFMPEG_ARGS = "ffmpeg -y -threads 0".split()
+FFMPEG_MP3_ARGS = ["-vn", "-c:a", "libmp3lame", *FFMPEG_BITRATE_ARG.split()]
 
-DISC_REGEX = r"(cd|disco?|disk)( |-)?0?[1-9]{1,2}"
+DISC_REGEX = re.compile(r"(cd|disco?|disk)( |-)?0?[1-9]{1,2}", flags=re.IGNORECASE)
 
 # TODO: reused as REQUIRED_FIELDS
 TAG_FIELDS = [
@@ -59,6 +72,20 @@ TAG_ABBREVS = {
     "TDRC": "date",
 }
 
+# MPEG-1 Layer III only
+MP3_BITRATES = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0]
+MP3_SAMPLERATES = [44100, 48000, 32000, 0]
+
+# id3 options passed to lame; keys must be in TAG_FIELDS
+LAME_TAG_OPTS = {
+    "artist": "--ta",
+    "genre": "--tg",
+    "tracknumber": "--tn",
+    "date": "--ty",
+    "title": "--tt",
+    "album": "--tl",
+}
+
 
 class Converter:
     """When initialised, `Converter` looks recursively for files to convert."""
@@ -69,29 +96,39 @@ class Converter:
     ):
         self.root_dir = root_dir
 
+        # the tree is only walked once; all subsequent changes to it (zip
+        # extraction, cue splitting, flattening) are tracked in self.files
         self.files = glob_full(
             self.root_dir,
             recursive=True,
             dirs_only=False,
         )
 
-        # from pprint import pprint
-        # pprint(self.files)
-        # raise ValueError
-
         # check for any 'stray' filetypes
-        zips = (f for f in self.files if f.endswith(".zip"))
+        zips = [f for f in self.files if f.endswith(".zip")]
 
         for zipf in zips:
             # print(zipf)
+            dest = os.path.dirname(zipf)
             with zipfile.ZipFile(zipf, "r") as zip_ref:
-                zip_ref.extractall(os.path.dirname(zipf))
+                for member in zip_ref.infolist():
+                    # members extracted by a previous (interrupted) run are
+                    # already in self.files
+                    if member.is_dir() or os.path.exists(
+                        os.path.join(dest, member.filename),
+                    ):
+                        continue
+                    self.files.append(zip_ref.extract(member, dest))
             Path(zipf).unlink()
+            self.files.remove(zipf)
+
+        self.files.sort()
 
     def split_cue(self):
         """I hate this so much"""
         # cue = file.removesuffix(ext) + "cue"
 
+        split_dirs: set[str] = set()
         for cue in [f for f in self.files if f.endswith("cue")]:
             flac = cue.removesuffix("cue") + "flac"
             if Path(flac).is_file():
@@ -117,24 +154,31 @@ class Converter:
                 # )
 
                 Path(flac).unlink()
+                split_dirs.add(os.path.dirname(cue))
 
-        # regen
-        self.files = glob_full(
-            self.root_dir,
-            recursive=True,
-            dirs_only=False,
-        )
+        if not split_dirs:
+            return
+
+        # only the dirs that were split need to be rescanned
+        files = [f for f in self.files if os.path.dirname(f) not in split_dirs]
+        for _dir in split_dirs:
+            with os.scandir(_dir) as entries:
+                files += [
+                    entry.path
+                    for entry in entries
+                    if not entry.is_dir() and not entry.name.startswith(".")
+                ]
+        self.files = sorted(files)
 
     def flatten_dirs(
         self,
         confirm: bool = False,
     ) -> None:
         """Flatten nested directories, to ease grouping/tagging of files."""
-        nested = glob_full(
-            self.root_dir,
-            dirs_only=True,
-            mindepth=2,
-        )
+        # files at least 2 dirs below root_dir
+        nested = [
+            f for f in self.files if os.path.relpath(f, self.root_dir).count("/") >= 2
+        ]
 
         if not nested:
             return
@@ -142,15 +186,17 @@ class Converter:
         # print("\n".join(sorted(nested)))
         # raise NotImplementedError
 
+        # header reads are i/o-bound, so they can be overlapped with threads
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            all_tags = list(executor.map(probe_tags, nested))
+
         targets: dict[str, str] = {}
-        for src in nested:
+        for src, tags in zip(nested, all_tags):
             _dir = get_merge_dest(src)
             # print(_dir)
             # raise ValueError
 
-            try:
-                tags = TinyTag.get(src)
-            except (TinyTagException, IsADirectoryError):
+            if tags is None:
                 # print("skip", file)
                 continue
 
@@ -165,11 +211,7 @@ class Converter:
                 disc = tags.disc
             else:
                 # 'CD01', 'CD 1 - BWV 9, 178, 187'
-                matches = re.search(
-                    DISC_REGEX,
-                    src.split("/")[-2],
-                    flags=re.IGNORECASE,
-                )
+                matches = DISC_REGEX.search(src.split("/")[-2])
                 if not matches:
                     continue
                 disc = int("".join(c for c in matches.group(0) if c.isnumeric()))
@@ -193,27 +235,31 @@ class Converter:
 
             targets[src] = dest
 
-            # assert src in self.files, src
-
-            # TODO: newly split flac(s) will not be in self.files
-            idx = self.files.index(src)
-            self.files[idx] = dest
-
         # raise Exception
 
         if not targets:
             return
 
+        # single pass, instead of a self.files.index() lookup per target
+        self.files = [targets.get(f, f) for f in self.files]
+
         if confirm and sys.__stdin__ and sys.__stdin__.isatty():
             print("\n".join(targets.values()))
             print(len(targets))
             input("continue")
 
+        # dest is always in a parent dir of src, i.e. on the same filesystem,
+        # so shutil.move's copy fallback is never needed
         for src, dest in targets.items():
-            shutil.move(src, dest)
+            os.replace(src, dest)
 
-        # cleanup empty dirs
-        os.system(f"find {shlex.quote(self.root_dir)} -type d -empty -delete")
+        # cleanup empty dirs; bottom-up, so that dirs emptied by removing
+        # their subdirs are removed too
+        for _dir, _, _ in os.walk(self.root_dir, topdown=False):
+            try:
+                os.rmdir(_dir)
+            except OSError:  # not empty
+                pass
 
     def convert_all(self) -> None:
         """Convert all files with a supported extension."""
@@ -222,12 +268,21 @@ class Converter:
         # lprint(self.files)
         # raise ValueError
 
-        with multiprocessing.Pool(2) as pool:
-            _ = pool.map(convert_file, self.files)
+        # the actual work is done by lame/ffmpeg subprocesses, so threads
+        # (which mostly just wait on them) are enough to use every core,
+        # without forking a python interpreter per worker
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(convert_file, f) for f in self.files]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+
 
-        # for file in tqdm(self.files):
-        #     print(file)
-        #     convert_file(file)
+def probe_tags(file: str) -> TinyTag | None:
+    """Read the tags of a file, or return None if it cannot be parsed."""
+    try:
+        return TinyTag.get(file)
+    except (TinyTagException, IsADirectoryError):
+        return None
 
 
 def get_merge_dest(file: str) -> str:
@@ -238,11 +293,7 @@ def get_merge_dest(file: str) -> str:
     while True:
         if _dir == "/":
             raise ValueError
-        if not re.search(
-            DISC_REGEX,
-            os.path.basename(_dir),
-            flags=re.IGNORECASE,
-        ):
+        if not DISC_REGEX.search(os.path.basename(_dir)):
             return _dir
         _dir = os.path.dirname(_dir)
 
@@ -255,7 +306,7 @@ def execute_chain(cmd_chain: list[list[str]]):
     # https://github.com/karamanolev/WhatManager2/blob/master/what_transcode/flac_lame.py
     processes = []
     # outs = []
-    for cmd in cmd_chain:
+    for i, cmd in enumerate(cmd_chain):
         # print(" ".join(cmd))
         if processes:
             # use stdout of last finished process as stdin
@@ -264,7 +315,8 @@ def execute_chain(cmd_chain: list[list[str]]):
         else:
             p_stdin = None  # stdin specified in cmd str
 
-        if cmd == cmd_chain[-1]:
+        # compare by index; identical cmds may occur more than once
+        if i == len(cmd_chain) - 1:
             p_stdout = None  # last cmd no need pipe (stdout in cmd)
         else:
             p_stdout = PIPE  # pipe to next cmd
@@ -279,43 +331,114 @@ def execute_chain(cmd_chain: list[list[str]]):
 
         # print(cmd)
         # pylint: disable=consider-using-with
-        subp = Popen(cmd, stdin=p_stdin, stdout=p_stdout)
+        # binary audio should always be fully buffered. close_fds must remain
+        # True (the default): chains are run concurrently, and a child that
+        # inherits another chain's pipe would keep it from ever reaching EOF
+        subp = Popen(
+            cmd,
+            stdin=p_stdin,
+            stdout=p_stdout,
+            bufsize=-1,
+            close_fds=True,
+        )
         assert subp.returncode is None
+        if p_stdin:
+            # the pipe now belongs to the child; closing the parent's copy
+            # allows the upstream process to receive SIGPIPE if this one exits
+            p_stdin.close()
         processes.append(subp)
         # subp.terminate()
 
-    # https://docs.python.org/2/library/subprocess.html#subprocess.Popen.communicate
+    # all pipes are either closed or consumed downstream, so there is nothing
+    # left to communicate()
     for subp in reversed(processes):
-        subp.communicate()
+        subp.wait()
+
+
+def get_mp3_bitrate(file: str) -> int:
+    """Get the bitrate (kbps) of an MP3 file from its first frame header,
+    without parsing the whole file.
+
+    For VBR files, the average bitrate is calculated from the Xing header. If
+    the header cannot be parsed (e.g. MPEG-2, VBRI header), mutagen is used
+    instead.
+    """
+    with open(file, "rb") as f:
+        head = f.read(10)
+        offset = 0
+        if head[:3] == b"ID3":
+            # tag size is a 28-bit syncsafe int, excluding the 10-byte header
+            offset = 10 + sum(
+                (b & 0x7F) << (7 * (3 - i)) for i, b in enumerate(head[6:])
+            )
+        f.seek(offset)
+        buf = f.read(4096)
+
+    i = buf.find(b"\xff")
+    while 0 <= i < len(buf) - 4:
+        # MPEG-1 Layer III
+        if buf[i + 1] & 0xFE == 0xFA:
+            break
+        i = buf.find(b"\xff", i + 1)
+    else:
+        return MP3(file).info.bitrate // 1000  # pylint: disable=no-member
+
+    header = buf[i : i + 4]
+    bitrate = MP3_BITRATES[header[2] >> 4]
+    samplerate = MP3_SAMPLERATES[(header[2] >> 2) & 0x3]
+    if not bitrate or not samplerate:
+        return MP3(file).info.bitrate // 1000  # pylint: disable=no-member
+
+    if buf[i + 36 : i + 40] == b"VBRI":
+        return MP3(file).info.bitrate // 1000  # pylint: disable=no-member
+
+    # the Xing header follows the side info, which is shorter for mono
+    xing = i + (21 if header[3] >> 6 == 3 else 36)
+    if buf[xing : xing + 4] != b"Xing":
+        # no header, or an Info header (CBR)
+        return bitrate
+
+    flags = int.from_bytes(buf[xing + 4 : xing + 8])
+    frames = int.from_bytes(buf[xing + 8 : xing + 12])
+    if flags & 0x3 != 0x3 or not frames:  # frame and byte counts are required
+        return MP3(file).info.bitrate // 1000  # pylint: disable=no-member
+    size = int.from_bytes(buf[xing + 12 : xing + 16])
+    return size * 8 * samplerate // (frames * 1152 * 1000)
+
 
+def get_lame_tag_args(old_tags: dict[str, list[str]]) -> list[str]:
+    """Convert tags from a lossless file (pre-conversion) into lame args, so
+    that they are written during encoding, instead of reopening the result.
+
+    lame only supports one value per field, so only the first is used.
+    """
+    # utf16 applies to all following options
+    args = ["--add-id3v2", "--id3v2-utf16"]
+    for field, opt in LAME_TAG_OPTS.items():
+        if field in old_tags:
+            args += [opt, old_tags[field][0]]
+    return args
 
-def copy_tags(
-    old_tags: Any,
-    new_file: str,
-):
-    """Copy tags from a lossless file (pre-conversion) into its lossy result.
 
-    The result is usually mp3.
+def get_ffmpeg_tag_args(old_tags: dict[str, list[str]]) -> list[str]:
+    """ffmpeg equivalent of `get_lame_tag_args`. All tags of the input file
+    are dropped, so that only TAG_FIELDS are written.
     """
-    new_tags: EasyMP3 = File(new_file, easy=True)
+    args = ["-map_metadata", "-1"]
     for field in TAG_FIELDS:
-        if field not in old_tags:
-            continue
-        if field == "date":
-            # date is a multi-spec field (allows multiple values)
-            new_tags[field] = old_tags[field]
-        else:
-            new_tags[field] = old_tags[field][0]
-    assert all(k in old_tags for k in new_tags)
-    new_tags.save()
+        if field in old_tags:
+            key = "track" if field == "tracknumber" else field
+            args += ["-metadata", f"{key}={old_tags[field][0]}"]
+    return args
 
 
 def convert_file(file: str):
     """Convert a single file to MP3.
 
-    Tags are typically only preserved within the same filetype (e.g. MP3 ->
-    MP3); in all other cases, it is necessary to extract tags from the input
-    file and apply them to the output file after conversion.
+    The encoder only ever receives decoded audio (even for MP3 -> MP3). MP3
+    tags are copied as is from the input file to the output; in all other
+    cases, it is necessary to extract tags from the input file and pass them
+    to the encoder.
 
     No logging is done, but it might be useful if conversion jobs are allowed
     to run repeatedly on the same set of files; this allows bitrate check to be
@@ -324,6 +447,35 @@ def convert_file(file: str):
 
     def parse_old_tags(file: str) -> dict[str, list[str]]:
         # note: ext is inherited from upper level
+        if ext in {"flac", "m4a", "opus"}:
+            # tinytag is considerably faster than mutagen, as it skips
+            # embedded pictures. mutagen is used if tinytag fails for any
+            # reason, or if tinytag would lose information.
+            #
+            # tinytag is not quite a drop-in replacement:
+            # - the track total is split off the tracknumber ("1/12" -> "1");
+            #   the raw value can no longer be recovered, so mutagen is used
+            #   whenever a total is present
+            # - all-digit genres are rewritten to ID3v1 genre names ("17" ->
+            #   "Rock")
+            try:
+                tags = TinyTag.get(file)
+                if tags.track_total in {None, "", "0"}:
+                    return {
+                        field: [val]
+                        for field, val in {
+                            "artist": tags.artist,
+                            "genre": tags.genre,
+                            "tracknumber": tags.track,
+                            "date": tags.year,
+                            "title": tags.title,
+                            "album": tags.album,
+                        }.items()
+                        if val
+                    }
+            except Exception:
+                pass
+
         if ext == "flac":
             # https://mutagen.readthedocs.io/en/latest/api/flac.html
             tags = FLAC(file).tags
@@ -346,13 +498,16 @@ def convert_file(file: str):
         return {}
 
     # print(file)
-    ext = file.rsplit(".", maxsplit=1)[-1]
+    # ext is normalised once, so that all checks below are case-insensitive
+    root, ext = os.path.splitext(file)
+    ext = ext[1:].lower()
     # print(ext)
 
-    if ext.lower() == "mp3":
-        tmp = os.path.dirname(file) + "/tmp"
+    if ext == "mp3":
+        # must be unique per file, as files are converted concurrently
+        tmp = file + ".tmp"
 
-        src_br = MP3(file).info.bitrate // 1000  # pylint: disable=no-member
+        src_br = get_mp3_bitrate(file)
 
         # target vbr: src files lower than 320 will be ignored
         if BITRATE_TARGET < 10 and src_br < 320:
@@ -362,21 +517,32 @@ def convert_file(file: str):
         if src_br < BITRATE_TARGET:
             return
 
+        # decode and encode in separate processes, so that both run
+        # concurrently
         execute_chain(
             # weird listy constructions are a lesser evil (compared to shlexing)
-            [f"lame --silent {BITRATE_ARG} --disptime 1".split() + [file, tmp]],
+            [
+                [*"lame --decode --silent".split(), file, "-"],
+                [*LAME_ARGS, "--disptime", "1", "-", tmp],
+            ],
         )
 
         if Path(tmp).is_file():
-            shutil.move(tmp, file)
+            # the encoder only sees pcm, so copy the whole tag (including
+            # cover art, albumartist, compilation, etc) over
+            try:
+                ID3(file).save(tmp)
+            except ID3NoHeaderError:
+                pass
+            os.replace(tmp, file)
         return
 
     # lossless files will always be converted to the target bitrate
 
     # .replace() should never be used as 'flac' can occur >1 time in a string
-    mp3 = file.removesuffix(ext) + "mp3"
+    mp3 = root + ".mp3"
 
-    cue = file.removesuffix(ext) + "cue"
+    cue = root + ".cue"
     if Path(cue).is_file():
         return
 
@@ -384,49 +550,47 @@ def convert_file(file: str):
         Path(file).unlink()
         return
 
-    if ext.lower() == "wav":
-        wav = file + "_.wav"
-    else:
-        wav = file.removesuffix(ext) + "wav"
-
     try:
         tags = parse_old_tags(file)
     except MP4StreamInfoError:
         Path(file).unlink()  # we cannot possibly recover from this
         return
 
-    if ext.lower() == "flac":
+    if ext == "flac":
         execute_chain(
             [
                 [*"flac --decode --stdout --totally-silent".split(), file],
-                [*f"lame --silent {BITRATE_ARG} -".split(), mp3],
+                [*LAME_ARGS, *get_lame_tag_args(tags), "-", mp3],
             ],
         )
 
     elif ext in CONVERT_EXTENSIONS:
-        # print(file)
-        # raise ValueError
-        # 2 separate commands (in shell, this would require process substitution)
+        # ffmpeg encodes with libmp3lame itself, so no separate lame process
+        # (or intermediate wav) is required
         try:
             # caused by yt-dlp downloads
-            execute_chain([[*"ffmpeg -y -i".split(), file, wav]])
             execute_chain(
-                [[*f"lame --silent {BITRATE_ARG} --disptime 1".split(), wav, mp3]],
+                [
+                    [
+                        *FFMPEG_ARGS,
+                        "-i",
+                        file,
+                        *FFMPEG_MP3_ARGS,
+                        *get_ffmpeg_tag_args(tags),
+                        mp3,
+                    ],
+                ],
             )
         except PermissionError:
             Path(file).unlink()
             return
 
-        if Path(wav).is_file():
-            Path(wav).unlink()
-
     else:
         raise NotImplementedError(file)
 
     # failed to convert, usually failed to read input
     if not Path(mp3).is_file():
         return
-    copy_tags(tags, mp3)
     Path(file).unlink()
     # print("Converted", file)
 
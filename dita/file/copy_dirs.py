@@ -21,9 +21,11 @@ Note: symlinks are typically not supported on Android
 
 # from pprint import pprint
 # from random import sample
+import itertools
 import os
 import sys
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import pandas as pd
 
@@ -33,24 +35,40 @@ from dita.discogs.collection import group_collection_by_artist
 from dita.discogs.collection import top_n_sum
 from dita.discogs.core import DISCOGS_CSV
 from dita.tag.core import eprint
-from dita.tag.core import shallow_recurse
+from dita.tag.io import shallow_recurse
 
 # from discogs.core import clean_artist
 
 
-# will be replaced with glob_full
-DIRNAMES_FOLD = {d.lower(): d for d in os.listdir(TARGET_DIR)}
+@lru_cache(maxsize=None)
+def get_dirnames_fold() -> dict[str, str]:
+    """Map casefolded artist dirnames in TARGET_DIR to their actual names.
+    Built on first use, so importing this module does not touch the
+    filesystem."""
+    with os.scandir(TARGET_DIR) as entries:
+        return {e.name.lower(): e.name for e in entries if e.is_dir()}
+
+
+@lru_cache(maxsize=None)
+def get_dir_bytes(_dir: str) -> int:
+    """Total size of all files under `_dir`. Symlinks to directories are not
+    followed. Cached, as the same dirs are sized repeatedly in main."""
+    total = 0
+    stack = [_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                # d_type is used where available, so neither check stats
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    total += entry.stat().st_size
+    return total
 
 
 def get_dirs_mb(dirs: list[str]) -> int:  # MB
     """Mimic du (unit: MB)"""
-    return sum(
-        f.stat().st_size
-        #
-        for _dir in dirs
-        for f in Path(_dir).glob("**/*")
-        if f.is_file()
-    ) // (10**6)
+    return sum(get_dir_bytes(_dir) for _dir in dirs) // (10**6)
 
 
 def limit_albums_of_artist(
@@ -62,15 +80,19 @@ def limit_albums_of_artist(
     if get_dirs_mb(all_dirs) < max_mb:
         return all_dirs
 
-    subset_mb = 0
-    subset = set()
-    all_dirs_set = set(all_dirs)
-    while subset_mb < max_mb and all_dirs_set:
-        alb = all_dirs_set.pop()
-        subset.add(alb)
-        subset_mb += get_dirs_mb([alb])
+    # take smallest albums first, so that the result is reproducible and
+    # keeps as many albums as possible. as before, the album that crosses
+    # max_mb is included, so at least one album is always kept
+    max_bytes = max_mb * 10**6
+    subset_bytes = 0
+    subset = []
+    for alb in sorted(set(all_dirs), key=get_dir_bytes):
+        if subset_bytes >= max_bytes:
+            break
+        subset.append(alb)
+        subset_bytes += get_dir_bytes(alb)
     # print(curr_mb, subset_mb)
-    return list(subset)
+    return subset
 
 
 def add_artists_with_translit(
@@ -87,12 +109,21 @@ def add_artists_with_translit(
     # 'стекловата (steklovata)',
     # 'هاني شنودة (hani shenouda)',
     # and maybe kyary
+    # index dirs once, instead of scanning them for every artist. for each
+    # possible artist prefix, only the first matching dir is kept
+    dirs_set = set(dirs)
+    front_matches: dict[str, str] = {}
+    for d in dirs:
+        i = d.find(" (")
+        while i != -1:
+            front_matches.setdefault(d[:i], d)
+            i = d.find(" (", i + 1)
+
     for art in top_artists:
-        if art in dirs:
-            dirs.append(DIRNAMES_FOLD[art])
-        front_matches = [d for d in dirs if d.startswith(art + " (")]
-        if front_matches:
-            dirs.append(front_matches[0])
+        if art in dirs_set:
+            dirs.append(get_dirnames_fold()[art])
+        if art in front_matches:
+            dirs.append(front_matches[art])
     return dirs
 
 
@@ -115,12 +146,11 @@ def main() -> list[str]:
     )
     df = pd.concat([one_5, filter_by_percentile(df, thresh=perc)])
 
-    # remove artists that do not have a dir (usually performers)
-    has_dir = df.artist.str.lower().isin(DIRNAMES_FOLD)
-    df = df[has_dir]
-
-    # adjust artist case to its dirname equivalent
-    df.artist = df.artist.apply(lambda x: DIRNAMES_FOLD[x.lower()])
+    # adjust artist case to its dirname equivalent, and remove artists that
+    # do not have a dir (usually performers)
+    dirnames = df.artist.str.lower().map(get_dirnames_fold())
+    df = df[dirnames.notna()]
+    df.artist = dirnames.dropna()
 
     df["paths"] = df.artist.apply(lambda x: shallow_recurse(f"{TARGET_DIR}/{x}", 1))
 
@@ -129,10 +159,18 @@ def main() -> list[str]:
         df["mult"] = round(df.mb / df.mb.mean(), 1)
         return df.mult.max() > max_weight
 
+    # size all album dirs up front, so that the loop below only hits the
+    # cache; scandir/stat release the GIL
+    all_dirs = list(itertools.chain.from_iterable(df.paths))
+    with ThreadPoolExecutor(max_workers=min(32, len(all_dirs) or 1)) as executor:
+        list(executor.map(get_dir_bytes, all_dirs))
+
     # iteratively shrink largest artist sizes towards mean
     while outliers_present():
         # print(df.mb.mean())
-        df.paths = df.paths.apply(lambda x: limit_albums_of_artist(x, df.mb.mean()))
+        # not evaluated in the lambda, where it would be recomputed per row
+        mean_mb = df.mb.mean()
+        df.paths = df.paths.apply(lambda x: limit_albums_of_artist(x, mean_mb))
 
     assert df[df["paths"].eq(False)].empty
 
@@ -159,10 +197,12 @@ def main() -> list[str]:
     #         int(len(remainder) * 0.1),
     #     )
 
-    while df.mb.sum() > TARGET_MB:
+    if df.mb.sum() > TARGET_MB:
         # sampling strategy for small TARGET_MB: drop random artists
-        # don't drop albums, as i hate incomplete discographies
-        df = df.sample(n=len(df) - 1)
+        # don't drop albums, as i hate incomplete discographies. equivalent to
+        # dropping one random artist at a time until under TARGET_MB
+        df = df.sample(frac=1)
+        df = df[df.mb.cumsum() <= TARGET_MB]
 
     dirs = sorted(df.paths.explode().str.removeprefix(TARGET_DIR + "/").values)
     print("\n".join(dirs))
@@ -3,6 +3,8 @@
 import os
 import shlex
 import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pandas as pd
@@ -13,25 +15,32 @@ from dita.config import QUEUE_FILE
 from dita.config import SOURCE_DIR
 from dita.config import STAGED_FILE
 from dita.config import TARGET_DIR
+from dita.tag.core import ASCII_REGEX
 from dita.tag.core import file_to_tags
-from dita.tag.core import front_int
 from dita.tag.core import get_files_tags
-from dita.tag.core import is_ascii
 from dita.tag.core import select_from_list
 from dita.tag.genre import GENRES
 from dita.tag.genre import save_db
 from dita.tag.io import get_audio_files
 from dita.tag.tagger import REQUIRED_FIELDS
 from dita.tag.tagger import edit_tag
-from dita.tag.tagger import tags_to_columns
 
 assert TARGET_DIR
 assert SOURCE_DIR
 
+# all dests start with this; stripped to get library relpaths
+TARGET_PREFIX = os.path.join(TARGET_DIR, "")
+
 MPV_DIR = f"{os.environ.get('XDG_CONFIG_HOME')}/mpv"
 
 # https://learn.microsoft.com/en-us/windows/win32/fileio/naming-a-file#naming-conventions
 NTFS_ILLEGALS = r'<>:"/\|?*'
+NTFS_TRANS = str.maketrans(
+    {c: "-" for c in NTFS_ILLEGALS} | {c: "'" for c in '"`'},
+)
+
+# removed from SOURCE_DIR during cleanup
+JUNK_EXTENSIONS = (".jpg", ".png", ".tif", ".cue", ".pdf", ".log", ".txt")
 
 # will be replaced by self.targets.moved (int/bool)
 MOVED_FILES: list[str] = []
@@ -69,10 +78,10 @@ class Mover:  # {{{
             return
 
         if self.src_dir == SOURCE_DIR:
-            # restrict to staged.txt
-            self.files = [
-                f for f in self.files if os.path.dirname(f) in dita.tag.fix.STAGED_DIRS
-            ]
+            # restrict to staged.txt. STAGED_DIRS is a list (it is appended to
+            # by fix), so membership is checked against a set
+            staged = set(dita.tag.fix.STAGED_DIRS)
+            self.files = [f for f in self.files if os.path.dirname(f) in staged]
 
         if not self.files:
             print("Nothing to move")
@@ -80,13 +89,12 @@ class Mover:  # {{{
 
         print(len(self.files), "files to move")
 
-        self.targets = pd.DataFrame(
-            [
-                {"file": f, "tags": file_to_tags(f)}
-                for f in self.files
-                if os.path.isfile(f)
-            ],
-        )
+        # tag reads are io-bound. get_audio_files has already checked that
+        # all files exist
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            tags = list(executor.map(file_to_tags, self.files))
+        self.targets = pd.DataFrame({"file": self.files, "tags": tags})
         self.regen_tag_columns()
 
         # corner case
@@ -122,43 +130,57 @@ class Mover:  # {{{
             "valid genre": self.targets.genre.isin(GENRES),
             "correct tracknum len": self.targets.tracknumber.str.len() >= 2,
             # "correct date len": self.targets.date.str.len() == 4,
-            "ascii artist": self.targets.artist.apply(is_ascii),
+            "ascii artist": self.targets.artist.str.contains(ASCII_REGEX, na=False),
             # "valid filename": self.targets.dest != "",
         }
+        # AND the masks, and slice the df only once
+        keep = pd.Series(True, index=self.targets.index)
         for name, cond in conditions.items():
-            fail = self.targets[~cond]
-            if not fail.empty:
-                print("Removed", len(fail), "files that do not have", name)
-                print(fail.src.to_list())
-            self.targets = self.targets[cond]
-            if self.targets.empty:
+            fail = keep & ~cond
+            if fail.any():
+                print("Removed", fail.sum(), "files that do not have", name)
+                print(self.targets.src[fail].to_list())
+            keep &= cond
+            if not keep.any():
+                self.targets = self.targets[keep]
                 print("emptied")
                 return
+        self.targets = self.targets[keep]
 
         # 1. determine full abspath
-        self.targets["dest"] = self.targets.apply(self.get_dest_filename, axis=1)
+        self.targets["dest"] = self.get_dest_filenames(self.targets)
 
         # this is a poor workaround
-        self.targets.tracknumber = self.targets.tracknumber.apply(
-            lambda t: t.split("/")[0],
-        )
+        self.targets.tracknumber = self.targets.tracknumber.str.split("/").str[0]
 
         if not (hundred := self.targets[self.targets.tracknumber.str.len() > 2]).empty:
             # if dir has >99 files, all files must have tracknumber of len 3
             # tags don't need to be updated
             hundred = self.targets.album.isin(hundred.album)
-            self.targets.loc[hundred, "tracknumber"] = self.targets[
-                hundred
-            ].tracknumber.apply(lambda x: str(int(x)).zfill(3))
-            self.targets["dest"] = self.targets.apply(self.get_dest_filename, axis=1)
+            self.targets.loc[hundred, "tracknumber"] = (
+                self.targets.loc[hundred, "tracknumber"]
+                .astype(int)
+                .astype(str)
+                .str.zfill(3)
+            )
+            # only these rows need new dests
+            self.targets.loc[hundred, "dest"] = self.get_dest_filenames(
+                self.targets[hundred]
+            )
 
         # 2. truncate fnames (before ext)
-        # TODO: apply() to affected rows only
-        too_long = self.targets[self.targets.dest.str.len() > 255]
-        if not too_long.empty:
-            self.targets.dest = self.targets.dest.apply(truncate_filename)
+        too_long = self.targets.dest.str.len() > 255
+        if too_long.any():
+            self.targets.loc[too_long, "dest"] = self.targets.dest[too_long].map(
+                truncate_filename
+            )
 
-        self.targets.tracknumber = self.targets.tracknumber.apply(front_int)
+        # equivalent to front_int
+        self.targets.tracknumber = (
+            self.targets.tracknumber.str.extract(r"^(\d+)", expand=False)
+            .fillna(0)
+            .astype(int)
+        )
 
         # 3. src_to_dest.compilation == 1 -> prepare make_va_symlinks
         # don't actually make them yet
@@ -213,30 +235,46 @@ class Mover:  # {{{
             print("\nTarget:", TARGET_DIR)
             input("Press enter to continue")
 
-        for _, row in self.targets.iterrows():
-            dest_dir = Path(row.dest).parent
-
+        # one mkdir per album, not per file
+        failed_dirs = set()
+        for dest_dir in set(self.targets.dest.map(os.path.dirname)):
             try:
-                Path(dest_dir).mkdir(parents=True, exist_ok=True)
+                os.makedirs(dest_dir, exist_ok=True)
             except OSError:
+                failed_dirs.add(dest_dir)
+
+        # rename can only succeed on the same filesystem; otherwise it would
+        # always fail with EXDEV, so copy straight away
+        try:
+            cross_fs = os.stat(self.src_dir).st_dev != os.stat(TARGET_DIR).st_dev
+        except OSError:
+            cross_fs = False  # unknown; let shutil.move work it out
+
+        for src, dest in zip(self.targets.src, self.targets.dest):
+            if os.path.dirname(dest) in failed_dirs:
                 continue
 
             # https://python.omics.wiki/file-operations/file-commands/os-rename-vs-shutil-move
             # copy2() attempts to preserve file metadata as well
             # in case of error, add more replacement rules to sanitize()
 
-            if row.src == row.dest:
-                print("Source matches destination:", row.src)
+            if src == dest:
+                print("Source matches destination:", src)
                 continue
 
             if move:
                 # overwrite can only be done when full dest path is provided
-                shutil.move(row.src, row.dest)
+                if cross_fs:
+                    # like shutil.move, but without the doomed rename attempt
+                    shutil.copy2(src, dest, follow_symlinks=False)
+                    os.unlink(src)
+                else:
+                    shutil.move(src, dest)
             else:
-                # shutil.copy(row.src, row.dest)
-                print(row.src)
+                # shutil.copy(src, dest)
+                print(src)
 
-            print(row.dest)
+            print(dest)
 
         # if not move:
         #     raise ValueError
@@ -250,67 +288,60 @@ class Mover:  # {{{
             self.cleanup()
 
     @staticmethod
-    def get_dest_filename(row: pd.Series) -> str:
-        """Construct destination filename from metadata in a row, then
-        add/update 'dest' field to/in the row. Format is fixed to:
+    def get_dest_filenames(targets: pd.DataFrame) -> pd.Series:
+        """Construct destination filenames from metadata in all rows. Format
+        is fixed to:
 
         <root>/<artist>/<album> (<date>)/<tracknumber> <title>.<ext>
         """
 
-        def sanitize_filename(parts: list[str]) -> list[str]:
+        def sanitize(part: pd.Series) -> pd.Series:
             """Remove characters illegal in NTFS filenames."""
-            path = []
-            for part in parts:
-                # catch blank values
-                assert isinstance(part, str), row.src
-                for char in part:
-                    if char in '"`':
-                        part = part.replace(char, "'")
-                    elif char in NTFS_ILLEGALS:
-                        part = part.replace(char, "-")
-                path.append(part.strip())
-            return path
-
-        # print(row)
-        ext = row.src.rsplit(".", maxsplit=1)[-1]
+            return part.str.translate(NTFS_TRANS).str.strip()
+
+        # catch blank values
+        fields = ["src", "artist", "album", "date", "tracknumber", "title"]
+        assert targets[fields].notna().all(axis=None), targets.src
+
+        ext = targets.src.str.rsplit(".", n=1).str[-1]
         dest = [
-            row.artist.strip("."),
-            f"{row.album} ({row.date[:4]})",  # TODO: trunc date tag (outside)
-            f"{row.tracknumber} {row.title}.{ext}",
+            targets.artist.str.strip("."),
+            # TODO: trunc date tag (outside)
+            targets.album + " (" + targets.date.str[:4] + ")",
+            targets.tracknumber + " " + targets.title + "." + ext,
         ]
-        assert all(dest)
-
-        return os.path.join(TARGET_DIR, *sanitize_filename(dest))
+        assert all(part.str.len().all() for part in dest)
 
-        # row = pd.Series(
-        #     os.path.join(TARGET_DIR, *sanitize_filename(dest)),
-        #     index=["dest"],
-        # )
-        # return row
+        artist, album, file = map(sanitize, dest)
+        return TARGET_PREFIX + artist + "/" + album + "/" + file
 
     def queue_new_albums(self) -> None:
         """Add new relpaths to library and queue files."""
         if self.targets.empty:
             return
 
-        paths = set(self.targets.dest.apply(os.path.dirname))
+        # 'artist/album (date)'
+        relpaths = (
+            self.targets.dest.str.rsplit("/", n=1)
+            .str[0]
+            .str.removeprefix(TARGET_PREFIX)
+            .unique()
+        )
 
         # sort by year only
-        paths = sorted(
-            paths,
+        relpaths = sorted(
+            relpaths,
             key=lambda x: (x.split()[-1]),
             # reverse=True
         )
 
-        print(f"{len(paths)} newly moved dirs")
+        print(f"{len(relpaths)} newly moved dirs")
 
         added_artists = set()
         added_albums = set()
-        new_queues = set()
+        new_queues = []
 
-        for path in paths:
-            # 'artist/album (date)'
-            relpath = path.removeprefix(TARGET_DIR + "/")
+        for relpath in relpaths:
             assert relpath.count("/") == 1, relpath
             artist, album = relpath.split("/")
 
@@ -320,16 +351,16 @@ class Mover:  # {{{
             added_artists.add(artist)
             added_albums.add(album)
 
-            new_queues.add(relpath)
+            new_queues.append(relpath)
 
         # this definitely works
         with Path(f"{MPV_DIR}/library").open(mode="a+", encoding="utf-8") as f:
-            f.writelines(d.removeprefix(TARGET_DIR + "/") + "\n" for d in paths)
+            f.write("".join(d + "\n" for d in relpaths))
 
         # but this may not
         with Path(QUEUE_FILE).open(mode="a+", encoding="utf-8") as f:
             # f.writelines(["\n"])  # else last line gets merged with first new line
-            f.writelines(x + "\n" for x in new_queues)
+            f.write("".join(x + "\n" for x in new_queues))
             # f.writelines("\n" + x for x in new_queues)
 
         print(len(added_artists), "dirs queued")
@@ -342,38 +373,59 @@ class Mover:  # {{{
         end of `move`.
         """
         # https://stackoverflow.com/a/12480543
-        # because of how os.walk works, root is not a "fixed" str, but instead
-        # gets increasingly deeper
-        for root, dirs, files in os.walk(self.src_dir):
+        # equivalent to os.walk (symlinked dirs are listed but not descended
+        # into), but file sizes are read from the cached DirEntry stat
+        stack = [self.src_dir]
+        while stack:
+            root = stack.pop()
+            try:
+                with os.scandir(root) as entries:
+                    entries = list(entries)
+            except OSError:
+                continue
+            dirs = [e for e in entries if e.is_dir()]
+            files = [e for e in entries if not e.is_dir()]
+            stack.extend(d.path for d in dirs if not d.is_symlink())
             # print(root)
             # print(dirs)
             # print(files)
-            if (
-                # root != base and
-                not dirs and not files
-            ):
-                # print("empty", root)
+            if dirs:
+                continue
+
+            # leaf dirs only: empty dirs have size 0. stop stat-ing as soon as
+            # the dir is known to be large
+            size = 0
+            for f in files:
+                size += f.stat().st_size
+                if size >= 5 * 10e5:
+                    break
+            if size < 5 * 10e5:
                 # print("Removed", root)
+                # might fail for no reason ("dir not empty")
                 shutil.rmtree(root)
 
-            if files and not dirs:
-                size = sum(os.path.getsize(os.path.join(root, f)) for f in files)
-                if size < 5 * 10e5:
-                    # print("Removed", root)
-                    # might fail for no reason ("dir not empty")
-                    shutil.rmtree(root)
-
         if not os.path.exists(self.src_dir):
             return
 
         if self.src_dir == SOURCE_DIR and os.path.isdir(self.src_dir):
             os.system(f"ncdu '{self.src_dir}'")
-            # remove images etc
-            os.system(
-                rf"find '{SOURCE_DIR}' -type f -regextype gnu-awk "
-                r"-iregex '.*\.(jpg|png|tif|cue|pdf|log|txt)$' -exec rm -v {} \;",
-            )
-            os.system(rf"find '{SOURCE_DIR}' -type d -empty -delete")
+            # remove images etc, then empty dirs (including SOURCE_DIR itself,
+            # like find -delete). ncdu may have changed the tree, so it is
+            # walked again. bottom-up, so that dirs emptied of junk files are
+            # removed too
+            for root, _, files in os.walk(SOURCE_DIR, topdown=False):
+                for file in files:
+                    path = os.path.join(root, file)
+                    if not file.lower().endswith(JUNK_EXTENSIONS):
+                        continue
+                    if os.path.islink(path):  # find -type f
+                        continue
+                    os.remove(path)
+                    print(f"removed '{path}'")
+                try:
+                    os.rmdir(root)
+                except OSError:  # not empty
+                    pass
         else:
             # this is just "source matches dest", probably no need to do anything
             os.system(f"ls -1 {shlex.quote(self.src_dir)}")
@@ -387,13 +439,21 @@ class Mover:  # {{{
     def regen_tag_columns(self) -> None:
         """Copied from fix.Tagger; should be refactored"""
         # print(self.targets.columns)
-        right = self.targets.tags.apply(dict).apply(pd.Series)
-        self.targets = self.targets[self.targets.columns.difference(right.columns)]
-        self.targets = self.targets.merge(
-            right,
-            left_index=True,
-            right_index=True,
-        ).map(tags_to_columns)
+        right = pd.DataFrame.from_records(
+            [dict(tags) for tags in self.targets.tags],
+            index=self.targets.index,
+        )
+        # equivalent to tags_to_columns, but per column: tag values are
+        # lists, and only the first item is used (empty list -> NaN)
+        for col in right.columns:
+            right[col] = right[col].str[0]
+        self.targets = pd.concat(
+            [
+                self.targets.drop(columns=right.columns, errors="ignore"),
+                right,
+            ],
+            axis=1,
+        )
 
     def dry_run(self) -> None:
         """Perform a dry-run of the move, then show the resulting relpaths.
@@ -403,21 +463,26 @@ class Mover:  # {{{
 
         def preview() -> pd.Series:  # [str, list[str]]
             print("Grouping...\n")
-            reverse = self.targets.copy()
-            reverse["dest"] = reverse.dest.apply(
-                lambda x: os.path.dirname(x.removeprefix(TARGET_DIR + "/")),
+            # relative dest dir; no need to copy the whole df
+            dest_dir = (
+                self.targets.dest.str.removeprefix(TARGET_PREFIX)
+                .str.rsplit("/", n=1)
+                .str[0]
             )
-            group: pd.Series = reverse.groupby("dest")["src"].apply(list)
+            group: pd.Series = self.targets.src.groupby(dest_dir).apply(list)
             return group
 
         # src dest
         # abc ['...', '...', '...']
 
         group = preview()
-        while dest_dir_to_fix := FzfPrompt().prompt(group.index.to_list(), "--reverse"):
-            files_to_fix: list[str] = group.loc[dest_dir_to_fix][0]
-            _mask = self.targets.src.isin(files_to_fix)
+        fzf = FzfPrompt()
+        while dest_dir_to_fix := fzf.prompt(group.index.to_list(), "--reverse"):
+            # prompt returns a list of selected lines
+            files_to_fix: list[str] = group.at[dest_dir_to_fix[0]]
             src_dir_to_fix = os.path.dirname(files_to_fix[0])
+            # Tagger can only modify files under its dir
+            mask = self.targets.src.str.startswith(src_dir_to_fix + "/")
 
             print(self.targets[self.targets.src == files_to_fix[0]].iloc[0].tags)
 
@@ -429,7 +494,16 @@ class Mover:  # {{{
             #
             # self.targets[mask, "tags"] = [file_to_tags(f) for f in files_to_fix]
             # X self.targets[mask, "tags"] = self.targets[mask].src.apply(file_to_tags)
-            self.targets["tags"] = self.targets.src.apply(file_to_tags)
+            # only reread tags of files that may have changed. .loc is avoided,
+            # as it would try to expand the dict-like tags
+            self.targets["tags"] = [
+                file_to_tags(src) if modified else tags
+                for src, tags, modified in zip(
+                    self.targets.src,
+                    self.targets.tags,
+                    mask,
+                )
+            ]
             self.regen_tag_columns()
 
             print(self.targets[self.targets.src == files_to_fix[0]].iloc[0].tags)
@@ -441,7 +515,7 @@ class Mover:  # {{{
             # for file in files_to_fix:
             #     # self.targets.at[] =...
             #     self.targets = self.targets.join(
-            #         self.targets.apply(self.get_dest_filename, axis=1)
+            #         self.get_dest_filenames(self.targets)
             #     )
             #     raise ValueError
 
@@ -509,7 +583,14 @@ def generate_symlinks(
     # .../artist/<album>/file.ext
 
     # albums = set(files.apply(lambda x: x.split("/")[-2]))
-    albums = {f.split("/")[-2] for f in files}
+    # group files (and their artists) by album in one pass
+    # (file, root, artist, fname); each path is only split once
+    albums: dict[str, list[tuple[str, str, str, str]]] = defaultdict(list)
+    album_artists: dict[str, set[str]] = defaultdict(set)
+    for f in files:
+        root, artist, album, fname = f.rsplit("/", 3)
+        albums[album].append((f, root, artist, fname))
+        album_artists[album].add(artist)
     # artists = {f.split("/")[-3] for f in files}
 
     # links = []
@@ -518,12 +599,8 @@ def generate_symlinks(
     # print(albums)
     # raise ValueError
 
-    for album in sorted(albums):
-        # actual ("orphan") files, before symlinking
-        # album_files: list[str] = [f for f in files if f"/{album}/" in f]
-
-        album_files: list[str] = [f for f in files if f"/{album}/" in f]
-
+    # actual ("orphan") files, before symlinking
+    for album, album_files in sorted(albums.items()):
         # use tracknum to determine 'uniqueness' of an album. this prevents the
         # following bad case from succeeding:
 
@@ -538,7 +615,7 @@ def generate_symlinks(
         # ]
 
         # for 2 va albums with same name (?)
-        if len({os.path.basename(f).split()[0] for f in album_files}) != len(
+        if len({fname.partition(" ")[0] for *_, fname in album_files}) != len(
             album_files,
         ):
             raise ValueError(
@@ -547,27 +624,23 @@ def generate_symlinks(
             )
             # return []
 
-        # artists of album
-        album_artists = {f.split("/")[-3] for f in album_files}
         # artists = set(files.apply(lambda x: x.split("/")[-3]))
 
         # album_links = []
-        for file in sorted(album_files):
-            for art in album_artists:
+        for file, root, curr_artist, fname in sorted(album_files):
+            for art in album_artists[album]:
                 # i doubt symlink 'paths' are subject to the same length limit;
                 # after all, nearly the whole library root is stripped
 
-                curr_artist = file.split("/")[-3]
                 if art == curr_artist:
                     continue
                 # make a symlink to every other artist
 
                 # only artist should be replaced, otherwise, you end up with
                 # Artist1/Artist1 - Artist2 -> Artist1/Artist1 - Artist1
-                dest = file.replace(f"/{curr_artist}/", f"/{art}/")
-
-                if os.path.isfile(dest):  # symlink already made
-                    continue
+                # existing links are not checked for here (a stat per link);
+                # relative_symlink already handles FileExistsError
+                dest = f"{root}/{art}/{album}/{fname}"
 
                 # lprint(file, curr_artist, src, dest)
 
@@ -390,26 +390,24 @@ def open_url(
     return base_url
 
 
+# any ascii char, except punctuation and space (space is not considered
+# punctuation). can be passed to pd.Series.str.contains
+ASCII_REGEX = re.compile(
+    "[^" + re.escape(string.punctuation + " ") + r"\x80-\U0010ffff]"
+)
+
+
 def is_ascii(artist: str) -> bool:
     """Like str.isascii(), but less strict (returns True if at least one ascii
-    char is present)"""
+    char is present, ignoring punctuation and spaces)"""
     # https://stackoverflow.com/a/266162
-    artist = artist.translate(str.maketrans("", "", string.punctuation))
-    artist = artist.replace(" ", "")  # space is not considered punctuation
-
-    # print(artist)
     # for c in artist:
     #     print(c, c.isascii(), c.isalnum(), c.isspace())
     # # م     False True  False
     # # ø     False True  False
     # # 원    False True  False
     # # space True  False True
-
-    if not any(c.isascii() for c in artist):
-        return False
-
-    # print("not ascii")
-    return True
+    return ASCII_REGEX.search(artist) is not None
 
 
 # }}}
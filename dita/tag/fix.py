@@ -108,7 +108,8 @@ def main() -> None:
 
     if len(sys.argv) == 1:
         dirs = glob_full(SOURCE_DIR)
-        dirs = [d for d in dirs if d not in STAGED_DIRS]
+        staged = set(STAGED_DIRS)
+        dirs = [d for d in dirs if d not in staged]
         if not dirs:
             sys.exit(0)
 
@@ -28,12 +28,12 @@ from dita.config import CONFIG
 from dita.config import PATH
 from dita.config import SOURCE_DIR
 from dita.config import TARGET_DIR
-from dita.file.convert import glob_full
 from dita.tag.core import add_headers
 from dita.tag.core import file_to_tags
 from dita.tag.core import select_from_list
 from dita.tag.core import set_tag
 from dita.tag.io import get_audio_files
+from dita.tag.io import glob_full
 from dita.tag.io import shallow_recurse
 
 GENRES_FILE = PATH + "/" + CONFIG["tag"]["genres"]
@@ -1,6 +1,7 @@
 import itertools
 import os
-from glob import glob
+from collections.abc import Collection
+from collections.abc import Iterator
 
 import filetype
 import pandas as pd
@@ -80,16 +81,44 @@ def shallow_recurse(
     if maxdepth == 0:
         return [parent]
 
-    children = [d.path for d in os.scandir(parent) if d.is_dir()]
+    # is_dir uses d_type where available, so no stat is needed
+    with os.scandir(parent) as entries:
+        children = [d.path for d in entries if d.is_dir()]
 
-    while maxdepth > 1:
-        grandch = [shallow_recurse(chi, maxdepth - 1) for chi in children]
-        grandch = list(itertools.chain.from_iterable(grandch))
-        return grandch
+    if maxdepth > 1:
+        return list(
+            itertools.chain.from_iterable(
+                shallow_recurse(chi, maxdepth - 1) for chi in children
+            )
+        )
 
     return children
 
 
+def scandir_recursive(
+    root_dir: str,
+    relpath: str = "",
+) -> Iterator[tuple[str, bool]]:
+    """Yield the relpath of every non-hidden item under `root_dir`, and
+    whether it is a directory. Symlinks to directories are followed. Order is
+    identical to that of `glob("**", recursive=True)`.
+
+    Unlike glob + os.path.isdir, file type is obtained from `os.scandir`,
+    which (usually) does not require an extra stat call per item.
+    """
+    try:
+        with os.scandir(os.path.join(root_dir, relpath)) as entries:
+            items = [(e.name, e.is_dir()) for e in entries if e.name[0] != "."]
+    except OSError:
+        return
+
+    for name, is_dir in items:
+        path = os.path.join(relpath, name)
+        yield path, is_dir
+        if is_dir:
+            yield from scandir_recursive(root_dir, path)
+
+
 def glob_full(
     root_dir: str,
     recursive: bool = True,
@@ -104,8 +133,6 @@ def glob_full(
     included (and has to be rejoined to all results). This takes care of that
     problem.
 
-    TODO: os.scandir
-
     Returns deepest directories by default (to avoid duplication). For files,
     use get_audio_files() instead.
 
@@ -121,41 +148,35 @@ def glob_full(
     # if mindepth == 0:
     #     return [root_dir]
 
-    items = glob(
-        "**",
-        root_dir=root_dir,
-        recursive=True,
-    )
-    # print(items)
-    # assert False
-
     if first_match:
-        gen = (x for x in items if x.endswith(first_match))
+        # the tree is only walked until the first match
+        gen = (x for x, _ in scandir_recursive(root_dir) if x.endswith(first_match))
         try:
             return [os.path.join(root_dir, next(gen))]
         except StopIteration:
             return []
 
+    items = list(scandir_recursive(root_dir))
+    # print(items)
+    # assert False
+
     if mindepth > 1:
         # depth 0 is root
         # depth 1 has 0 slashes
         # lprint(items)
-        items = [x for x in items if x.count("/") >= mindepth]
-        items = [os.path.join(root_dir, x) for x in items]
-        return items
-
-    items = [os.path.join(root_dir, x) for x in items]
+        return [os.path.join(root_dir, x) for x, _ in items if x.count("/") >= mindepth]
 
     if dirs_only:
         # deepest only
         new_list = []
-        for item in reversed(sorted(items)):
+        for item, is_dir in reversed(sorted(items)):
             # a/b/c
             # a/b
             # a
-            if any(item in x for x in new_list):
+            if not is_dir:
                 continue
-            if not os.path.isdir(item):
+            item = os.path.join(root_dir, item)
+            if any(item in x for x in new_list):
                 continue
             new_list.append(item)
         return new_list
@@ -163,11 +184,11 @@ def glob_full(
 
     return sorted(
         [
-            x
-            for x in items
+            os.path.join(root_dir, x)
+            for x, is_dir in items
             # if os.path.isfile(x)
             # allow dead symlinks (will be cleared by is_audio_file)
-            if not os.path.isdir(x)
+            if not is_dir
             # a rather absurd corner case caused by 2 files containing a word
             # which was encoded differently but displayed the same. "Güld'ner"
             # is the 'invalid' encoding, as it contains an invisible
@@ -182,7 +203,7 @@ def glob_full(
 
 def is_audio_file(
     file: str,
-    extensions: list[str],
+    extensions: Collection[str],
 ) -> bool:
     """Check that `file`:
         1. is a file
@@ -194,9 +215,10 @@ def is_audio_file(
     python-magic, but can yield false negatives (e.g. ape).
     """
 
-    # m4a ext = mp4 filetype
-    if "m4a" in extensions:
-        extensions.append("mp4")
+    # m4a ext = mp4 filetype. extensions must not be mutated, as it is
+    # typically a module-level constant
+    if "m4a" in extensions and "mp4" not in extensions:
+        extensions = {*extensions, "mp4"}
 
     ext = file.split(".")[-1].lower()
 
@@ -0,0 +1,143 @@
+import shutil
+import struct
+
+import pytest
+from mutagen.easyid3 import EasyID3
+from mutagen.flac import FLAC
+from mutagen.id3 import APIC
+from mutagen.id3 import ID3
+from mutagen.id3 import TCMP
+from mutagen.id3 import TIT2
+from mutagen.id3 import TPE1
+from mutagen.id3 import TPE2
+from mutagen.id3 import TPOS
+from mutagen.id3 import TRCK
+from mutagen.mp3 import MP3
+
+import dita.file.convert as dc
+from dita.file.convert import convert_file
+from dita.file.convert import get_mp3_bitrate
+
+
+def make_frame(
+    bitrate_idx: int,
+    payload: bytes = b"",
+) -> bytes:
+    """Construct an MPEG-1 Layer III frame (48 kHz, stereo)."""
+    bitrate = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+    length = 144 * bitrate[bitrate_idx] * 1000 // 48000
+    header = bytes([0xFF, 0xFB, (bitrate_idx << 4) | (1 << 2), 0])
+    return (header + payload).ljust(length, b"\x00")
+
+
+def test_mp3_bitrate(tmp_path):
+    cbr = tmp_path / "cbr.mp3"
+    cbr.write_bytes(make_frame(14) * 50)
+    tags = EasyID3()
+    tags["title"] = "x" * 5000  # push the first frame beyond the first read
+    tags.save(cbr)
+    assert get_mp3_bitrate(str(cbr)) == 320
+    assert get_mp3_bitrate(str(cbr)) == MP3(cbr).info.bitrate // 1000
+
+    frames = [make_frame(9)] * 25 + [make_frame(14)] * 25
+    xing = (
+        b"\x00" * 32
+        + b"Xing"
+        + (3).to_bytes(4)
+        + len(frames).to_bytes(4)
+        + sum(map(len, frames)).to_bytes(4)
+    )
+    vbr = tmp_path / "vbr.mp3"
+    vbr.write_bytes(make_frame(9, xing) + b"".join(frames))
+    # mutagen's length calculation differs slightly
+    assert get_mp3_bitrate(str(vbr)) == 224
+    assert abs(get_mp3_bitrate(str(vbr)) - MP3(vbr).info.bitrate // 1000) < 5
+
+
+def make_tagged_mp3(path) -> str:
+    """320 kbps mp3 with both text and non-text frames."""
+    path.write_bytes(make_frame(14) * 200)
+    tags = ID3()
+    for frame in [
+        TPE1(text="Foo"),
+        TPE2(text="Various Artists"),
+        TIT2(text="Baz"),
+        TRCK(text="01/12"),
+        TPOS(text="2"),
+        TCMP(text="1"),
+        APIC(mime="image/jpeg", type=3, desc="", data=b"\xff\xd8" * 100),
+    ]:
+        tags.add(frame)
+    tags.save(path)
+    return str(path)
+
+
+def test_mp3_recompress_keeps_tags(tmp_path, monkeypatch):
+    src = make_tagged_mp3(tmp_path / "a.mp3")
+    old_tags = ID3(src).pprint()
+    chains = []
+
+    def encode(chain):
+        # stand-in for lame: write an untagged (lower bitrate) mp3
+        chains.append(chain)
+        with open(chain[-1][-1], "wb") as f:
+            f.write(make_frame(9) * 50)
+
+    monkeypatch.setattr(dc, "execute_chain", encode)
+    convert_file(src)
+
+    [(decode, *_, encode_args)] = chains
+    assert decode[0] == "lame" and decode[-2:] == [src, "-"]
+    assert encode_args[-2:] == ["-", src + ".tmp"]
+    assert not (tmp_path / "a.mp3.tmp").exists()
+    assert get_mp3_bitrate(src) == 128  # result of the encoder replaced src
+    assert ID3(src).pprint() == old_tags
+
+
+@pytest.mark.skipif(not shutil.which("lame"), reason="lame not installed")
+def test_mp3_recompress_keeps_tags_lame(tmp_path):
+    src = make_tagged_mp3(tmp_path / "a.mp3")
+    old_tags = ID3(src).pprint()
+    with open(src, "rb") as f:
+        before = f.read()
+
+    convert_file(src)
+
+    with open(src, "rb") as f:
+        assert f.read() != before  # actually recompressed
+    assert ID3(src).pprint() == old_tags
+
+
+def make_flac(path, comments: list[str]) -> str:
+    """Construct a flac with no audio frames, only STREAMINFO (44.1 kHz,
+    stereo, 16 bit) and VORBIS_COMMENT."""
+    streaminfo = b"\x00" * 10 + bytes([0x0A, 0xC4, 0x42, 0xF0]) + b"\x00" * 20
+    vc = struct.pack("<II", 0, len(comments))
+    for c in comments:
+        vc += struct.pack("<I", len(c.encode())) + c.encode()
+    path.write_bytes(
+        b"fLaC"
+        + b"\x00"
+        + len(streaminfo).to_bytes(3)
+        + streaminfo
+        + b"\x84"  # last block
+        + len(vc).to_bytes(3)
+        + vc
+    )
+    return str(path)
+
+
+def test_flac_tracknumber(tmp_path, monkeypatch):
+    chains = []
+    monkeypatch.setattr(dc, "execute_chain", chains.append)
+
+    for comments in [
+        ["TRACKNUMBER=01"],
+        ["TRACKNUMBER=1/12"],
+        ["TRACKNUMBER=1", "TRACKTOTAL=12"],
+    ]:
+        src = make_flac(tmp_path / "a.flac", comments)
+        expected = FLAC(src)["tracknumber"][0]
+        convert_file(src)
+        encode_args = chains[-1][-1]
+        assert encode_args[encode_args.index("--tn") + 1] == expected
@@ -33,6 +33,28 @@ def test_release_print():
     )
 
 
+def test_doubled_tracklist():
+    def tracklist(titles: list[str]) -> dict:
+        return {
+            "tracklist": [
+                {"position": str(i), "type_": "track", "title": t, "duration": ""}
+                for i, t in enumerate(titles, start=1)
+            ]
+        }
+
+    doubled = release.get_release_tracklist(tracklist(["a", "b", "c"] * 2))
+    assert doubled.title.to_list() == ["a", "b", "c"]
+
+    for titles in [
+        ["a", "b", "a", "c"],
+        ["a", "a", "a", "a"],
+        ["a", "b", "c", "d"],
+    ]:
+        assert (
+            release.get_release_tracklist(tracklist(titles)).title.to_list() == titles
+        )
+
+
 def test_list_diff():
     left = ["aaa", "bbb", "ccc", "ddd", "eee"]
     right = ["aaa", "ccc", "eee", "fff"]